@@ -1,12 +1,26 @@
 import streamlit as st
-import tempfile
 import os
 import zipfile
+import tarfile
 import io
+import hashlib
+import numpy as np
+import zstandard
 from markitdown import MarkItDown
-from pathlib import Path
-from concurrent.futures import ThreadPoolExecutor, as_completed
-import threading
+from concurrent.futures import ThreadPoolExecutor
+import time
+
+# Upper bound on conversion threads per batch; malformed values fall back to 8
+try:
+    MAX_WORKERS = max(1, int(os.environ.get("CONVERTMD_MAX_WORKERS", "8")))
+except ValueError:
+    MAX_WORKERS = 8
+
+# ASCII bytes str.split() and str.splitlines() treat as separators
+WHITESPACE_BYTES = np.zeros(256, dtype=bool)
+WHITESPACE_BYTES[[0x09, 0x0A, 0x0B, 0x0C, 0x0D, 0x1C, 0x1D, 0x1E, 0x1F, 0x20]] = True
+LINE_BREAK_BYTES = np.zeros(256, dtype=bool)
+LINE_BREAK_BYTES[[0x0A, 0x0B, 0x0C, 0x0D, 0x1C, 0x1D, 0x1E]] = True
 
 # Configure page
 st.set_page_config(page_title="convertmd", page_icon="📄", layout="centered")
@@ -22,103 +36,177 @@ st.markdown(
 )
 
 
-def convert_document(uploaded_file):
-    """Quick document conversion"""
-    with tempfile.NamedTemporaryFile(
-        delete=False, suffix=f"_{uploaded_file.name}"
-    ) as tmp_file:
-        tmp_file.write(uploaded_file.getvalue())
-        tmp_file_path = tmp_file.name
+@st.cache_resource(show_spinner=False)
+def get_converter():
+    """Shared MarkItDown instance, built once per server process"""
+    return MarkItDown()
+
+
+@st.cache_data(show_spinner=False, max_entries=64)
+def convert_bytes(data, file_extension):
+    """UTF-8 markdown for a document's bytes, memoized on bytes and extension"""
+    # Exceptions propagate so that st.cache_data only ever stores successes
+    md_converter = get_converter()
+    result = md_converter.convert_stream(
+        io.BytesIO(data), file_extension=file_extension
+    )
+    if result and result.text_content:
+        return result.text_content.encode("utf-8")
+    return None
 
+
+def convert_document(file_name, data):
+    """Quick document conversion to UTF-8 markdown"""
     try:
-        md_converter = MarkItDown()
-        result = md_converter.convert(tmp_file_path)
-        os.unlink(tmp_file_path)
+        content = convert_bytes(data, os.path.splitext(file_name)[1])
 
-        if result and result.text_content:
-            return result.text_content, None
+        if content:
+            return content, None
         else:
             return None, "No content extracted"
     except Exception as e:
-        if os.path.exists(tmp_file_path):
-            os.unlink(tmp_file_path)
         return None, str(e)
 
 
+def text_stats(content):
+    """Word and line counts from a single byte scan
+
+    Matches str.split() and str.splitlines() for ASCII separators; the
+    non-ASCII ones (NBSP, U+2028, ...) are not treated as breaks.
+    """
+    arr = np.frombuffer(content, dtype=np.uint8)
+    if arr.size == 0:
+        return 0, 0
+
+    # A word starts wherever a non-whitespace byte follows whitespace (or
+    # opens the text)
+    is_space = WHITESPACE_BYTES[arr]
+    words = int(np.count_nonzero(is_space[:-1] & ~is_space[1:])) + int(not is_space[0])
+
+    # \r\n is a single break, so drop the \r of each pair; a trailing
+    # unterminated line still counts as a line
+    is_break = LINE_BREAK_BYTES[arr]
+    is_break[:-1] &= ~((arr[:-1] == 0x0D) & (arr[1:] == 0x0A))
+    lines = int(np.count_nonzero(is_break)) + int(not is_break[-1])
+    return words, lines
+
+
+def build_zip(files):
+    """Pack (filename, content) pairs into an in-memory zip archive"""
+    # Archives are downloaded once and discarded, so favour speed over ratio:
+    # small batches and tiny entries are stored as-is, everything else uses
+    # the fastest DEFLATE level
+    store_all = sum(len(content) for _, content in files) < 256 * 1024
+
+    zip_buffer = io.BytesIO()
+    with zipfile.ZipFile(zip_buffer, "w", compresslevel=1) as zip_file:
+        for filename, content in files:
+            if store_all or len(content) < 1024:
+                compression = zipfile.ZIP_STORED
+            else:
+                compression = zipfile.ZIP_DEFLATED
+            zip_file.writestr(filename, content, compress_type=compression)
+
+    return zip_buffer.getvalue()
+
+
+def build_tar_zst(files):
+    """Pack (filename, content) pairs into an in-memory zstd-compressed tarball"""
+    # Compressing the tar stream as a whole lets zstd exploit boilerplate
+    # shared across files, which per-entry zip DEFLATE cannot
+    tar_buffer = io.BytesIO()
+    mtime = time.time()
+    compressor = zstandard.ZstdCompressor(level=3)
+    with compressor.stream_writer(tar_buffer, closefd=False) as zstd_stream:
+        with tarfile.open(fileobj=zstd_stream, mode="w|") as tar_file:
+            for filename, content in files:
+                info = tarfile.TarInfo(filename)
+                info.size = len(content)
+                info.mtime = mtime
+                tar_file.addfile(info, io.BytesIO(content))
+
+    return tar_buffer.getvalue()
+
+
 def convert_batch(uploaded_files):
-    """Convert multiple files in parallel and return as zip"""
-    converted_files = []
-    errors = []
+    """Convert multiple files in parallel and return (name, content, error) per file"""
+    results = []
 
     progress_bar = st.progress(0)
     status_text = st.empty()
-    completed_count = 0
     total_files = len(uploaded_files)
 
-    # Thread-safe counter for progress updates
-    progress_lock = threading.Lock()
-
-    def update_progress(filename):
-        nonlocal completed_count
-        with progress_lock:
-            completed_count += 1
+    # Coalesce UI updates: redraw every ~5% of files or 100 ms, and at the end
+    emit_step = max(1, total_files // 20)
+    last_emit_count = 0
+    last_emit_ts = 0.0
+
+    def update_progress(completed_count):
+        nonlocal last_emit_count, last_emit_ts
+        now = time.monotonic()
+        if (
+            completed_count == total_files
+            or completed_count - last_emit_count >= emit_step
+            or now - last_emit_ts > 0.1
+        ):
+            last_emit_count = completed_count
+            last_emit_ts = now
             status_text.text(f"Completed {completed_count}/{total_files} files...")
             progress_bar.progress(completed_count / total_files)
 
-    def convert_single_file(file):
-        """Convert a single file and return result"""
-        try:
-            content, error = convert_document(file)
-            update_progress(file.name)
-
-            if content:
-                filename = f"{Path(file.name).stem}.md"
-                return (filename, content, None)
-            else:
-                return (None, None, f"{file.name}: {error}")
-        except Exception as e:
-            update_progress(file.name)
-            return (None, None, f"{file.name}: {str(e)}")
-
-    # Use ThreadPoolExecutor with max 5 workers
-    with ThreadPoolExecutor(max_workers=min(5, total_files)) as executor:
-        # Submit all conversion tasks
-        future_to_file = {
-            executor.submit(convert_single_file, file): file for file in uploaded_files
-        }
-
-        # Process completed futures
-        for future in as_completed(future_to_file):
-            filename, content, error = future.result()
-            if content:
-                converted_files.append((filename, content))
-            else:
-                errors.append(error)
+    # Parsing is mostly CPU-bound, so past a few threads extra workers only add
+    # contention: use about one per two files, capped by cores and MAX_WORKERS.
+    # File bytes are read here so workers never touch the UploadedFile objects
+    max_workers = min(
+        os.cpu_count() or 4, max(2, total_files // 2), MAX_WORKERS, total_files
+    )
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        names = [file.name for file in uploaded_files]
+        outcomes = executor.map(
+            convert_document, names, [file.getvalue() for file in uploaded_files]
+        )
+
+        # Progress is counted on the script thread as results arrive, so the
+        # counter needs no lock and widgets are only touched from this thread
+        for completed_count, (name, (content, error)) in enumerate(
+            zip(names, outcomes), 1
+        ):
+            update_progress(completed_count)
+            results.append((name, content, error))
 
     progress_bar.empty()
     status_text.empty()
 
-    if converted_files:
-        # Create zip file in memory
-        zip_buffer = io.BytesIO()
-        with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-            for filename, content in converted_files:
-                zip_file.writestr(filename, content)
+    return results
+
+
+def store_content(file_name, content):
+    """Record converted content, sharing one copy between identical outputs"""
+    digest = hashlib.blake2b(content, digest_size=16).digest()
+    st.session_state.converted_blobs.setdefault(digest, content)
+    st.session_state.converted_files_data[file_name] = digest
 
-        zip_buffer.seek(0)
-        return zip_buffer.getvalue(), errors
-    else:
-        return None, errors
+
+def get_content(file_name):
+    """Converted content for an uploaded file, or None"""
+    digest = st.session_state.converted_files_data.get(file_name)
+    if digest is None:
+        return None
+    return st.session_state.converted_blobs[digest]
 
 
 def main():
     # Initialize session state
     if "converted_files_data" not in st.session_state:
-        st.session_state.converted_files_data = {}  # Dict: filename -> content
+        st.session_state.converted_files_data = {}  # Dict: filename -> content hash
+    if "converted_blobs" not in st.session_state:
+        st.session_state.converted_blobs = {}  # Dict: content hash -> UTF-8 bytes
     if "conversion_errors" not in st.session_state:
         st.session_state.conversion_errors = {}  # Dict: filename -> error
     if "last_files" not in st.session_state:
         st.session_state.last_files = []
+    if "archive_cache" not in st.session_state:
+        st.session_state.archive_cache = {}  # Dict: batch key -> archive bytes
     if "clear_files" not in st.session_state:
         st.session_state.clear_files = False
 
@@ -144,8 +232,10 @@ def main():
             # Set flag to clear files and reset session state
             st.session_state.clear_files = not st.session_state.clear_files
             st.session_state.converted_files_data = {}
+            st.session_state.converted_blobs = {}
             st.session_state.conversion_errors = {}
             st.session_state.last_files = []
+            st.session_state.archive_cache = {}
             st.rerun()
 
     if uploaded_files:
@@ -160,11 +250,12 @@ def main():
             st.session_state.converted_files_data.pop(removed_file, None)
             st.session_state.conversion_errors.pop(removed_file, None)
 
-        # Find new files that need conversion
+        # Find new files that need conversion (failed files are not retried)
         new_files = [
             f
             for f in uploaded_files
             if f.name not in st.session_state.converted_files_data
+            and f.name not in st.session_state.conversion_errors
         ]
 
         # Convert new files
@@ -173,9 +264,9 @@ def main():
                 # Single file - convert directly
                 file = new_files[0]
                 with st.spinner(f"Converting {file.name}..."):
-                    content, error = convert_document(file)
+                    content, error = convert_document(file.name, file.getvalue())
                 if content:
-                    st.session_state.converted_files_data[file.name] = content
+                    store_content(file.name, content)
                     st.session_state.conversion_errors.pop(
                         file.name, None
                     )  # Remove any previous error
@@ -185,38 +276,26 @@ def main():
                         file.name, None
                     )  # Remove any previous content
             else:
-                # Multiple files - use parallel processing
-                with st.spinner(f"Converting {len(new_files)} files..."):
-
-                    def convert_and_store(file):
-                        content, error = convert_document(file)
-                        return file.name, content, error
-
-                    # Use ThreadPoolExecutor for parallel conversion
-                    with ThreadPoolExecutor(
-                        max_workers=min(5, len(new_files))
-                    ) as executor:
-                        # Submit all conversion tasks
-                        future_to_filename = {
-                            executor.submit(convert_and_store, file): file.name
-                            for file in new_files
-                        }
-
-                        # Process completed futures
-                        for future in as_completed(future_to_filename):
-                            filename, content, error = future.result()
-                            if content:
-                                st.session_state.converted_files_data[filename] = (
-                                    content
-                                )
-                                st.session_state.conversion_errors.pop(
-                                    filename, None
-                                )  # Remove any previous error
-                            else:
-                                st.session_state.conversion_errors[filename] = error
-                                st.session_state.converted_files_data.pop(
-                                    filename, None
-                                )  # Remove any previous content
+                # Multiple files - parallel processing with a progress bar
+                for filename, content, error in convert_batch(new_files):
+                    if content:
+                        store_content(filename, content)
+                        st.session_state.conversion_errors.pop(
+                            filename, None
+                        )  # Remove any previous error
+                    else:
+                        st.session_state.conversion_errors[filename] = error
+                        st.session_state.converted_files_data.pop(
+                            filename, None
+                        )  # Remove any previous content
+
+        # Drop contents no longer referenced by any uploaded file
+        referenced = set(st.session_state.converted_files_data.values())
+        st.session_state.converted_blobs = {
+            digest: content
+            for digest, content in st.session_state.converted_blobs.items()
+            if digest in referenced
+        }
 
         # Update last files list
         st.session_state.last_files = current_file_names
@@ -224,18 +303,18 @@ def main():
         # Handle single file
         if len(uploaded_files) == 1:
             uploaded_file = uploaded_files[0]
-            content = st.session_state.converted_files_data.get(uploaded_file.name)
+            content = get_content(uploaded_file.name)
             error = st.session_state.conversion_errors.get(uploaded_file.name)
 
             if content:
                 st.success("Converted!")
 
                 # Quick stats
-                words = len(content.split())
-                st.caption(f"{words:,} words • {len(content.splitlines())} lines")
+                words, lines = text_stats(content)
+                st.caption(f"{words:,} words • {lines} lines")
 
                 # Download
-                filename = f"{Path(uploaded_file.name).stem}.md"
+                filename = f"{os.path.splitext(uploaded_file.name)[0]}.md"
                 st.download_button(
                     "Download Markdown",
                     data=content,
@@ -246,7 +325,7 @@ def main():
 
                 # Preview
                 with st.expander("Preview", expanded=False):
-                    st.code(content, language="markdown")
+                    st.code(content.decode("utf-8"), language="markdown")
             else:
                 st.error(f"Error: {error}")
 
@@ -254,29 +333,22 @@ def main():
         else:
             # Get converted files and errors for current uploads
             converted_files = []
+            content_keys = []
             errors = []
 
             for file in uploaded_files:
                 if file.name in st.session_state.converted_files_data:
-                    filename = f"{Path(file.name).stem}.md"
-                    content = st.session_state.converted_files_data[file.name]
+                    filename = f"{os.path.splitext(file.name)[0]}.md"
+                    digest = st.session_state.converted_files_data[file.name]
+                    content = st.session_state.converted_blobs[digest]
                     converted_files.append((filename, content))
+                    content_keys.append((filename, digest))
                 elif file.name in st.session_state.conversion_errors:
                     errors.append(
                         f"{file.name}: {st.session_state.conversion_errors[file.name]}"
                     )
 
-            # Create zip if we have converted files
-            zip_data = None
             if converted_files:
-                zip_buffer = io.BytesIO()
-                with zipfile.ZipFile(zip_buffer, "w", zipfile.ZIP_DEFLATED) as zip_file:
-                    for filename, content in converted_files:
-                        zip_file.writestr(filename, content)
-                zip_buffer.seek(0)
-                zip_data = zip_buffer.getvalue()
-
-            if zip_data:
                 st.success(
                     f"Batch conversion complete! {len(uploaded_files) - len(errors)} files converted."
                 )
@@ -286,25 +358,55 @@ def main():
                         for error in errors:
                             st.error(error)
 
-                # Download zip
-                st.download_button(
-                    "Download ZIP Archive",
-                    data=zip_data,
-                    file_name="converted_markdown_files.zip",
-                    mime="application/zip",
-                    use_container_width=True,
+                archive_format = st.radio(
+                    "Archive format",
+                    ["ZIP", "tar.zst"],
+                    horizontal=True,
+                    help="tar.zst compresses all files together: smaller and faster, "
+                    "but needs a zstd-capable extractor",
                 )
+
+                # Build the archive, reusing the last one while the batch and
+                # format are unchanged
+                archive_key = (archive_format, tuple(sorted(content_keys)))
+                archive_data = st.session_state.archive_cache.get(archive_key)
+                if archive_data is None:
+                    if archive_format == "ZIP":
+                        archive_data = build_zip(converted_files)
+                    else:
+                        archive_data = build_tar_zst(converted_files)
+                    st.session_state.archive_cache = {archive_key: archive_data}
+
+                # Download archive
+                if archive_format == "ZIP":
+                    st.download_button(
+                        "Download ZIP Archive",
+                        data=archive_data,
+                        file_name="converted_markdown_files.zip",
+                        mime="application/zip",
+                        use_container_width=True,
+                    )
+                else:
+                    st.download_button(
+                        "Download tar.zst Archive",
+                        data=archive_data,
+                        file_name="converted_markdown_files.tar.zst",
+                        mime="application/zstd",
+                        use_container_width=True,
+                    )
             else:
                 st.error("No files could be converted. Check the error details above.")
 
     else:
         # Clear session state when no files are uploaded
         st.session_state.converted_files_data = {}
+        st.session_state.converted_blobs = {}
         st.session_state.conversion_errors = {}
         st.session_state.last_files = []
+        st.session_state.archive_cache = {}
         # Show supported formats info only if no file is uploaded
         st.info("**Supported formats:** PDF, Word, PowerPoint, Excel, E-Book")
-        st.caption("Single file -> Direct download | Multiple files -> ZIP archive")
+        st.caption("Single file -> Direct download | Multiple files -> ZIP / tar.zst")
 
 
 if __name__ == "__main__":